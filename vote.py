@@ -1,29 +1,55 @@
 import csv
-import json
+import hashlib
+import heapq
 import os
 import random
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain, islice
 from pathlib import Path
 from typing import Iterable
 
+import orjson
 from tqdm import tqdm
 
 APPLICATIONS_DIR = Path(__file__).parent / "applications"
 CODEX_HOME = Path(__file__).parent / "badgeholder"
 SCHEMA_PATH = CODEX_HOME / "schema.json"
+CACHE_DIR = CODEX_HOME / "cache"
 OUTPUT_CSV = Path(__file__).parent / "comparisons.csv"
 MIN_APPEARANCES = 10
 SEED = 100
-MAX_WORKERS = 20
+WORKERS_PER_CPU = 8
+LOAD_WORKERS = 16
+BATCH_SIZE = 8
+FLUSH_EVERY = 16
+# set to False to ask codex again for every pair instead of reusing cached verdicts
+REUSE_VERDICTS = True
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "winners": {
+            "type": "array",
+            "items": {"type": "string", "enum": ["project_a", "project_b"]},
+        }
+    },
+    "required": ["winners"],
+    "additionalProperties": False,
+}
 
 
 def load_projects(directory: Path) -> dict[str, dict]:
     """Return a mapping of project_name to the full JSON payload."""
+    paths = sorted(directory.glob("*.json"))
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        payloads = list(
+            executor.map(lambda path: orjson.loads(path.read_bytes()), paths)
+        )
+
     projects: dict[str, dict] = {}
-    for path in sorted(directory.glob("*.json")):
-        with path.open() as f:
-            data = json.load(f)
+    for path, data in zip(paths, payloads):
         name = data.get("project_name")
         if not name:
             raise ValueError(f"Missing project_name in {path}")
@@ -35,15 +61,6 @@ def load_projects(directory: Path) -> dict[str, dict]:
     return projects
 
 
-def rotate_roster(roster: list[str | None]) -> list[str | None]:
-    """Rotate all elements except the first one step to the right."""
-    if len(roster) <= 2:
-        return roster
-    rest = roster[1:]
-    rest = rest[-1:] + rest[:-1]
-    return [roster[0], *rest]
-
-
 def generate_pairs(
     projects: Iterable[str],
     min_appearances: int = MIN_APPEARANCES,
@@ -64,14 +81,25 @@ def generate_pairs(
         roster.append(None)  # bye slot for odd counts
 
     counts = {name: 0 for name in roster if name is not None}
+    # min-heap of (count, name); entries whose count is outdated are skipped lazily
+    heap = [(0, name) for name in counts]
+    heapq.heapify(heap)
+
+    def lowest_count() -> int:
+        while heap[0][0] != counts[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0][0]
+
     pairs: list[tuple[str, str]] = []
     round_number = 0
     max_rounds = (min_appearances + 1) * len(roster)
+    half = len(roster) // 2
+    # the first slot stays put while the rest rotate one step right each round
+    fixed, rest = roster[0], deque(roster[1:])
 
-    while min(counts.values()) < min_appearances:
-        half = len(roster) // 2
-        first_half = roster[:half]
-        second_half = list(reversed(roster[half:]))
+    while lowest_count() < min_appearances:
+        first_half = chain([fixed], islice(rest, half - 1))
+        second_half = reversed(rest)
 
         for left, right in zip(first_half, second_half):
             if left is None or right is None:
@@ -81,29 +109,36 @@ def generate_pairs(
             pairs.append((left, right))
             counts[left] += 1
             counts[right] += 1
+            heapq.heappush(heap, (counts[left], left))
+            heapq.heappush(heap, (counts[right], right))
 
         round_number += 1
         if round_number > max_rounds:
             raise RuntimeError("Unable to satisfy pairing requirement.")
-        roster = rotate_roster(roster)
+        rest.rotate(1)
 
     return pairs
 
 
-def build_prompt(project_a: dict, project_b: dict) -> str:
-    """Format the prompt expected by codex exec."""
-    project_a_json = json.dumps(project_a, indent=2)
-    project_b_json = json.dumps(project_b, indent=2)
+def build_prompt(pairs: list[tuple[str, str]]) -> str:
+    """Format the prompt expected by codex exec from pre-serialized project pairs."""
+    sections = []
+    for idx, (project_a_json, project_b_json) in enumerate(pairs, start=1):
+        sections.append(
+            f'<pair index="{idx}">\n'
+            "<project_a>\n"
+            f"{project_a_json}\n"
+            "</project_a>\n"
+            "<project_b>\n"
+            f"{project_b_json}\n"
+            "</project_b>\n"
+            "</pair>\n"
+        )
     return (
-        "Which project has been more impactful for Filecoin?\n"
-        "<projects>\n"
-        "<project_a>\n"
-        f"{project_a_json}\n"
-        "</project_a>\n"
-        "<project_b>\n"
-        f"{project_b_json}\n"
-        "</project_b>\n"
-        "</projects>"
+        "For each pair, which project has been more impactful for Filecoin?\n"
+        "<pairs>\n"
+        f"{''.join(sections)}"
+        "</pairs>"
     )
 
 
@@ -117,8 +152,9 @@ def call_codex(prompt: str) -> dict:
             "exec",
             "--output-schema",
             str(SCHEMA_PATH),
-            prompt,
+            "-",
         ],
+        input=prompt,
         capture_output=True,
         text=True,
         check=False,
@@ -129,39 +165,147 @@ def call_codex(prompt: str) -> dict:
             f"codex exec failed with exit code {result.returncode}: {result.stderr.strip()}"
         )
     try:
-        return json.loads(result.stdout)
-    except json.JSONDecodeError as exc:
+        return orjson.loads(result.stdout)
+    except orjson.JSONDecodeError as exc:
         raise ValueError(
             f"Failed to parse codex output as JSON: {exc}\nOutput:\n{result.stdout}"
         ) from exc
 
 
+def verdict_context(seed: int = SEED) -> str:
+    """Hash everything besides the two projects that can change a verdict."""
+    digest = hashlib.sha256()
+    for part in (
+        (CODEX_HOME / "AGENTS.md").read_bytes(),
+        (CODEX_HOME / "config.toml").read_bytes(),
+        orjson.dumps(OUTPUT_SCHEMA),
+        build_prompt([]).encode(),
+        str(seed).encode(),
+    ):
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def cache_path(context: str, hash_a: str, hash_b: str, occurrence: int) -> Path:
+    """Return the cache file for the `occurrence`-th comparison of two payloads."""
+    low, high = sorted((hash_a, hash_b))
+    key = f"{context}|{low}|{high}|{occurrence}"
+    return CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+
+def load_cached_winner(path: Path) -> str | None:
+    """Return the cached winner name stored at `path`, if any."""
+    if not path.exists():
+        return None
+    try:
+        return orjson.loads(path.read_bytes())["winner_name"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return None
+
+
+def store_cached_winner(path: Path, name_a: str, name_b: str, winner_name: str) -> None:
+    """Persist the winner of a pair atomically so crashes never leave partial files."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, suffix=".tmp", delete=False
+    ) as tmp:
+        tmp.write(
+            orjson.dumps({
+                "project_a": name_a,
+                "project_b": name_b,
+                "winner_name": winner_name,
+            })
+        )
+    os.replace(tmp.name, path)
+
+
 def main() -> None:
+    SCHEMA_PATH.write_bytes(orjson.dumps(OUTPUT_SCHEMA, option=orjson.OPT_INDENT_2))
     projects = load_projects(APPLICATIONS_DIR)
+    projects_json = {
+        name: orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+        for name, data in projects.items()
+    }
+    project_hashes = {
+        name: hashlib.sha256(payload.encode()).hexdigest()
+        for name, payload in projects_json.items()
+    }
+    context = verdict_context()
     pairs = generate_pairs(projects)
 
-    def evaluate_pair(pair: tuple[str, str]) -> tuple[str, str, str, str]:
-        name_a, name_b = pair
-        prompt = build_prompt(projects[name_a], projects[name_b])
+    def evaluate_batch(
+        job: tuple[list[tuple[str, str, Path]], str],
+    ) -> list[tuple[str, str, str, str]]:
+        batch, prompt = job
         response = call_codex(prompt)
-        winner_key = response.get("winner")
-        if winner_key not in {"project_a", "project_b"}:
-            raise ValueError(f"Unexpected winner value: {winner_key!r}")
-        winner_name = name_a if winner_key == "project_a" else name_b
-        return name_a, name_b, winner_key, winner_name
+        winner_keys = response.get("winners")
+        if not isinstance(winner_keys, list) or len(winner_keys) != len(batch):
+            raise ValueError(f"Expected {len(batch)} winners, got: {winner_keys!r}")
+        rows = []
+        for (name_a, name_b, path), winner_key in zip(batch, winner_keys):
+            if winner_key not in {"project_a", "project_b"}:
+                raise ValueError(f"Unexpected winner value: {winner_key!r}")
+            winner_name = name_a if winner_key == "project_a" else name_b
+            store_cached_winner(path, name_a, name_b, winner_name)
+            rows.append((name_a, name_b, winner_key, winner_name))
+        return rows
+
+    known: list[tuple[str, str, str, str]] = []
+    pending: list[tuple[str, str, Path]] = []
+    # repeated match-ups within a run are independent samples, not cache hits
+    occurrences: Counter[frozenset[str]] = Counter()
+    for name_a, name_b in pairs:
+        occurrence = occurrences[frozenset((name_a, name_b))]
+        occurrences[frozenset((name_a, name_b))] += 1
+        path = cache_path(
+            context, project_hashes[name_a], project_hashes[name_b], occurrence
+        )
+        winner_name = load_cached_winner(path) if REUSE_VERDICTS else None
+        if winner_name not in (name_a, name_b):
+            pending.append((name_a, name_b, path))
+            continue
+        winner_key = "project_a" if winner_name == name_a else "project_b"
+        known.append((name_a, name_b, winner_key, winner_name))
+    batches = [
+        pending[idx : idx + BATCH_SIZE] for idx in range(0, len(pending), BATCH_SIZE)
+    ]
+    jobs = [
+        (
+            batch,
+            build_prompt([(projects_json[a], projects_json[b]) for a, b, _ in batch]),
+        )
+        for batch in batches
+    ]
+    max_workers = max(1, min(len(jobs), (os.cpu_count() or 4) * WORKERS_PER_CPU))
 
     with OUTPUT_CSV.open("w", newline="") as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(["project_a", "project_b", "winner", "winner_name"])
+        writer.writerows(known)
         csvfile.flush()
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            with tqdm(total=len(pairs), desc="Comparisons", unit="pair") as progress:
-                for name_a, name_b, winner_key, winner_name in executor.map(
-                    evaluate_pair, pairs
-                ):
-                    writer.writerow([name_a, name_b, winner_key, winner_name])
-                    csvfile.flush()
-                    progress.update(1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(evaluate_batch, job) for job in jobs]
+            with tqdm(
+                total=len(pairs),
+                initial=len(known),
+                desc="Comparisons",
+                unit="pair",
+            ) as progress:
+                written = 0
+                try:
+                    for future in as_completed(futures):
+                        rows = future.result()
+                        for row in rows:
+                            writer.writerow(row)
+                            written += 1
+                            if written % FLUSH_EVERY == 0:
+                                csvfile.flush()
+                        progress.update(len(rows))
+                except BaseException:
+                    # drop batches that have not started instead of waiting on them
+                    for future in futures:
+                        future.cancel()
+                    raise
 
 
 if __name__ == "__main__":